@@ -1,33 +1,136 @@
 import os
+import atexit
+import hashlib
 import logging
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash
+import queue
+import sqlite3
+import click
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, abort, g, has_request_context
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from sqlalchemy import delete, event, func, insert, literal, select, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import deferred, joinedload, undefer
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, date, timedelta
-import json
+from functools import lru_cache, wraps
+import orjson
+import redis
 import requests
 from anthropic import Anthropic
+from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
 from dotenv import load_dotenv
 
 load_dotenv()
-print("API Key loaded:", os.getenv('ANTHROPIC_API_KEY')[:5] if os.getenv('ANTHROPIC_API_KEY') else "No API key found")
 
 if not os.path.exists('logs'):
     os.mkdir('logs')
-logging.basicConfig(
-    filename='logs/app.log',
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s: %(message)s'
-)
+
+# Request threads only enqueue records; the listener thread does the file I/O
+log_queue = queue.SimpleQueue()
+file_handler = RotatingFileHandler('logs/app.log', maxBytes=10_000_000, backupCount=3)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+log_listener = QueueListener(log_queue, file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(log_queue))
+
 logging.info("Application startup")
+logging.info("API key %s", "loaded" if os.getenv('ANTHROPIC_API_KEY') else "not found")
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, used by jsonify, request.json and |tojson"""
+    options = orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response, skipping the str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=self.options),
+            mimetype='application/json'
+        )
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///fitness_tracker.db'
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+app.config['REDIS_URL'] = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+# Size the pool to at least the worker's thread count (e.g. gunicorn --threads)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    'connect_args': {'check_same_thread': False}
+}
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
+# Short timeouts so an unavailable Redis degrades to a cache miss instead of a stall
+redis_client = redis.Redis.from_url(
+    app.config['REDIS_URL'],
+    socket_connect_timeout=0.5,
+    socket_timeout=0.5
+)
+# Meal analysis runs on an RQ worker (`rq worker meal_analysis`) so requests don't wait on the API
+meal_analysis_queue = Queue('meal_analysis', connection=redis_client)
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        # SQLite ignores ON DELETE CASCADE unless foreign keys are enabled per connection
+        cursor.execute("PRAGMA foreign_keys=ON")
+        # WAL lets readers proceed while a write is in progress
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.close()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_request_queries(conn, cursor, statement, parameters, context, executemany):
+    if (app.debug or app.testing) and has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+@app.after_request
+def add_query_count_header(response):
+    # In debug mode every response reports how many SQL statements it took
+    if app.debug:
+        response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+    return response
+
+def max_queries(limit):
+    """Flag a view whose request runs more than limit SQL statements (debug and testing only)."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            response = view(*args, **kwargs)
+            query_count = g.get('query_count', 0)
+            if query_count > limit:
+                # A jump past the limit usually means a lazy load crept into a loop (N+1)
+                message = f"{request.endpoint} ran {query_count} queries, limit is {limit}"
+                if app.testing:
+                    raise AssertionError(message)
+                logging.warning(message)
+            return response
+        return wrapper
+    return decorator
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -35,18 +138,35 @@ login_manager.login_view = 'login'
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    # Nearly every page needs the settings row, so fetch it in the same query
+    return db.session.get(User, int(user_id), options=[joinedload(User.settings)])
+
+# Exercise lists: plain JSON on SQLite, JSONB on Postgres so they can be GIN-indexed
+EXERCISES_JSON = db.JSON().with_variant(JSONB(), 'postgresql')
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    email = db.Column(db.String(254), nullable=False)
+    # Werkzeug's default scrypt hashes are 162 characters
+    password_hash = db.Column(db.String(255))
+    # Filled in by the database as part of the INSERT
+    created_at = db.Column(db.DateTime, nullable=False, server_default=func.now())
+    deleted_at = db.Column(db.DateTime)
+
+    # Emails are unique case-insensitively, and only among accounts that haven't been deleted
+    __table_args__ = (
+        db.Index('uq_user_email_active', func.lower(email), unique=True,
+                 sqlite_where=text('deleted_at IS NULL'), postgresql_where=text('deleted_at IS NULL')),
+    )
     
-    settings = db.relationship('UserSettings', backref='user', uselist=False)
-    saved_meals = db.relationship('SavedMeal', backref='user')
-    nutrition_entries = db.relationship('NutritionEntry', backref='user')
-    workouts = db.relationship('Workout', backref='user')
+    settings = db.relationship('UserSettings', backref='user', uselist=False,
+                               cascade='all, delete-orphan', passive_deletes=True)
+    saved_meals = db.relationship('SavedMeal', backref='user',
+                                  cascade='all, delete-orphan', passive_deletes=True)
+    nutrition_entries = db.relationship('NutritionEntry', backref='user',
+                                        cascade='all, delete-orphan', passive_deletes=True)
+    workouts = db.relationship('Workout', backref='user',
+                               cascade='all, delete-orphan', passive_deletes=True)
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -54,66 +174,134 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    @classmethod
+    def find_active(cls, email):
+        """Look up a non-deleted user by email, ignoring case (served by uq_user_email_active)."""
+        return cls.query.filter(func.lower(cls.email) == func.lower(email), cls.deleted_at.is_(None)).first()
+
+# Weights, height and ratios need two decimals at most. Postgres packs them as numeric(5,2);
+# SQLite keeps REAL since NUMERIC affinity would hand whole numbers back as ints
+SETTINGS_DECIMAL = db.Float().with_variant(db.Numeric(precision=5, scale=2, asdecimal=False), 'postgresql')
+
+# Fixed choices from the settings forms. Native enum types on Postgres, VARCHAR with a CHECK elsewhere
+ACTIVITY_LEVEL_ENUM = db.Enum('sedentary', 'light', 'moderate', 'heavy', 'athlete', name='activity_level_enum', create_constraint=True)
+GENDER_ENUM = db.Enum('male', 'female', 'other', name='gender_enum', create_constraint=True)
+
 class UserSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'), nullable=False, index=True)
     
-    current_weight_kg = db.Column(db.Float, nullable=False)
-    target_weight_kg = db.Column(db.Float, nullable=False)
-    starting_weight_kg = db.Column(db.Float, nullable=False)
+    current_weight_kg = db.Column(SETTINGS_DECIMAL, nullable=False)
+    target_weight_kg = db.Column(SETTINGS_DECIMAL, nullable=False)
+    starting_weight_kg = db.Column(SETTINGS_DECIMAL, nullable=False)
     
-    protein_ratio = db.Column(db.Float, nullable=False)
-    max_calories = db.Column(db.Integer, nullable=False, default=2500)
-    start_date = db.Column(db.DateTime, nullable=False)
-    goal_months = db.Column(db.Integer, nullable=False)
-
-    activity_level = db.Column(db.String(20), nullable=False)
-    gender = db.Column(db.String(10), nullable=False)
-    height_inches = db.Column(db.Float, nullable=False)
-    age = db.Column(db.Integer, nullable=False)
+    protein_ratio = db.Column(SETTINGS_DECIMAL, nullable=False)
+    max_calories = db.Column(db.SmallInteger, nullable=False, default=2500)
+    start_date = db.Column(db.DateTime, nullable=False, server_default=func.now())
+    goal_months = db.Column(db.SmallInteger, nullable=False)
+
+    activity_level = db.Column(ACTIVITY_LEVEL_ENUM, nullable=False)
+    gender = db.Column(GENDER_ENUM, nullable=False)
+    height_inches = db.Column(SETTINGS_DECIMAL, nullable=False)
+    age = db.Column(db.SmallInteger, nullable=False)
+
+    __table_args__ = (
+        db.CheckConstraint('height_inches > 0', name='ck_settings_height_positive'),
+        db.CheckConstraint('age BETWEEN 0 AND 150', name='ck_settings_age_range'),
+    )
 
 class WeightEntry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'), nullable=False)
     date = db.Column(db.Date, nullable=False)
     weight = db.Column(db.Float, nullable=False)
     
-    user = db.relationship('User', backref='weight_entries')
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'date', name='uq_weight_user_date'),
+        db.CheckConstraint('weight > 0', name='ck_weight_positive'),
+    )
+    
+    user = db.relationship('User', backref=db.backref('weight_entries',
+                           cascade='all, delete-orphan', passive_deletes=True))
+
+# Running per-day sums of NutritionEntry, kept in step by every nutrition write path
+class DailyNutritionTotal(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    protein_total = db.Column(db.Float, nullable=False, default=0)
+    calorie_total = db.Column(db.Integer, nullable=False, default=0)
+    entry_count = db.Column(db.Integer, nullable=False, default=0)
+    user = db.relationship('User', backref=db.backref('daily_nutrition_totals',
+                           cascade='all, delete-orphan', passive_deletes=True))
+
+    # Only ever reached by its (user_id, date) key, so SQLite can store it in the key's B-tree
+    __table_args__ = {'sqlite_with_rowid': False}
 
 class SavedMeal(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'), nullable=False, index=True)
     name = db.Column(db.String(100), nullable=False)
     protein_per_serving = db.Column(db.Float, nullable=False)
     calories_per_serving = db.Column(db.Integer, nullable=False)
+    # ETags need sub-second precision, so the ORM still stamps these; the server default covers raw SQL inserts
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=func.now())
 
 class NutritionEntry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'), nullable=False)
     date = db.Column(db.Date, nullable=False)
     protein_amount = db.Column(db.Float, nullable=False)
     calorie_amount = db.Column(db.Integer, nullable=False)
     meal_name = db.Column(db.String(100))
 
+    __table_args__ = (
+        db.Index('ix_nutrition_user_date', 'user_id', 'date'),
+        db.CheckConstraint('protein_amount >= 0', name='ck_nutrition_protein_nonneg'),
+        db.CheckConstraint('calorie_amount >= 0', name='ck_nutrition_calorie_nonneg'),
+    )
+
 class Workout(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'), nullable=False)
+    date = db.Column(db.Date, nullable=False, default=date.today)
     type = db.Column(db.String(50), nullable=False)
-    exercises = db.Column(db.Text, nullable=False)
+    # Only loaded on access or with undefer(); the JSON can be large
+    exercises = deferred(db.Column(EXERCISES_JSON, nullable=False))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=func.now())
 
-class WorkoutCategory(db.Model):
+    __table_args__ = (
+        db.Index('ix_workout_user_date', 'user_id', 'date'),
+        db.Index('ix_workout_user_type_date', 'user_id', 'type', 'date'),
+    )
+
+# One row per entry of Workout.exercises, so single exercises can be found through an index
+class WorkoutExercise(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    name = db.Column(db.String(50), nullable=False) 
-    exercises = db.Column(db.Text, nullable=False) 
-    user = db.relationship('User', backref='workout_categories')
+    workout_id = db.Column(db.Integer, db.ForeignKey('workout.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'), nullable=False)
+    position = db.Column(db.SmallInteger, nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    sets = db.Column(db.SmallInteger)
+    reps = db.Column(db.SmallInteger)
+    weight = db.Column(db.Float)
 
-    def get_exercises(self):
-        return json.loads(self.exercises)
+    __table_args__ = (
+        db.Index('ix_workout_exercise_user_name', 'user_id', 'name'),
+    )
 
-    def set_exercises(self, exercises_list):
-        self.exercises = json.dumps(exercises_list)
+class WorkoutCategory(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE', deferrable=True, initially='DEFERRED'), nullable=False)
+    name = db.Column(db.String(50), nullable=False) 
+    exercises = db.Column(EXERCISES_JSON, nullable=False) 
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=func.now())
+    user = db.relationship('User', backref=db.backref('workout_categories',
+                           cascade='all, delete-orphan', passive_deletes=True))
+
+    # Also serves user_id lookups as the index's leading column
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'name', name='uq_workout_category_user_name'),
+    )
 
 def determine_weight_direction(current_weight_kg, target_weight_kg):
     """
@@ -191,6 +379,84 @@ def calculate_calorie_target(current_weight_kg, settings):
         logging.error(f"Error calculating calories: {str(e)}")
         raise
 
+# Per-user JSON list responses cached in Redis; dropped whenever the list changes
+USER_LIST_CACHE_TTL = 60 * 60
+
+def user_cache_key(user_id, name):
+    return f'user:{user_id}:{name}'
+
+def get_cached_body(cache_key):
+    try:
+        return redis_client.get(cache_key)
+    except redis.RedisError as e:
+        logging.warning(f"Response cache unavailable: {str(e)}")
+        return None
+
+def set_cached_body(cache_key, body):
+    try:
+        redis_client.setex(cache_key, USER_LIST_CACHE_TTL, body)
+    except redis.RedisError as e:
+        logging.warning(f"Response cache unavailable: {str(e)}")
+
+def invalidate_cached_bodies(*cache_keys):
+    try:
+        redis_client.delete(*cache_keys)
+    except redis.RedisError as e:
+        logging.warning(f"Response cache unavailable: {str(e)}")
+
+def row_etag(row):
+    """Strong ETag for a single row, derived from its id and last update time"""
+    return hashlib.md5(f"{row.id}-{row.updated_at}".encode()).hexdigest()
+
+def conditional_response(etag, build_response):
+    """Answer 304 when the client already holds etag, otherwise build and tag the response"""
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = build_response()
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def refresh_daily_nutrition_total(user_id, day):
+    """Recompute the user's DailyNutritionTotal row for day from their NutritionEntry rows"""
+    db.session.flush()
+    # Summed from the entries rather than adjusted by deltas, so float totals can't drift
+    totals = select(
+        literal(user_id),
+        literal(day),
+        func.coalesce(func.sum(NutritionEntry.protein_amount), 0),
+        func.coalesce(func.sum(NutritionEntry.calorie_amount), 0),
+        func.count(NutritionEntry.id)
+    ).where(NutritionEntry.user_id == user_id, NutritionEntry.date == day)
+    stmt = sqlite_insert(DailyNutritionTotal).from_select(
+        ['user_id', 'date', 'protein_total', 'calorie_total', 'entry_count'], totals
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'date'],
+        set_={
+            'protein_total': stmt.excluded.protein_total,
+            'calorie_total': stmt.excluded.calorie_total,
+            'entry_count': stmt.excluded.entry_count
+        }
+    ))
+
+def add_workout_exercise_rows(workout):
+    """Insert a WorkoutExercise row for each named exercise in a flushed workout's exercises JSON"""
+    # Unnamed entries stay in the JSON as before; they just can't be looked up by name
+    rows = [{
+        'workout_id': workout.id,
+        'user_id': workout.user_id,
+        'position': position,
+        'name': exercise['name'],
+        'sets': exercise.get('sets'),
+        'reps': exercise.get('reps'),
+        'weight': exercise.get('weight')
+    } for position, exercise in enumerate(workout.exercises) if isinstance(exercise, dict) and exercise.get('name')]
+    if rows:
+        db.session.execute(insert(WorkoutExercise), rows)
+
 def create_default_workout_categories(user_id):
     default_categories = [
         {
@@ -227,16 +493,16 @@ def create_default_workout_categories(user_id):
         workout_category = WorkoutCategory(
             user_id=user_id,
             name=category["name"],
-            exercises=json.dumps(category["exercises"])
+            exercises=category["exercises"]
         )
         db.session.add(workout_category)
 
-def get_llm_nutrition_estimate(meal_description):
-    anthropic = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
-    
-    prompt = f"""You are analyzing a meal to estimate its nutritional content. Break down each component and provide protein and calorie estimates.
+# Static prompt text is built once; only the meal description varies per call
+NUTRITION_PROMPT_PREFIX = """You are analyzing a meal to estimate its nutritional content. Break down each component and provide protein and calorie estimates.
     
-    Meal: {meal_description}
+    Meal: """
+
+NUTRITION_PROMPT_SUFFIX = """
     
     Rules:
     1. Always provide realistic estimates even with vague portions
@@ -245,23 +511,54 @@ def get_llm_nutrition_estimate(meal_description):
     4. If portion is unclear, assume a typical serving size
     
     Provide your response in this exact JSON format:
-    {{
-        "total": {{
+    {
+        "total": {
             "protein": 0,
             "calories": 0
-        }},
+        },
         "breakdown": [
-            {{
+            {
                 "item": "food name",
                 "portion": "amount",
                 "protein": 0,
                 "calories": 0
-            }}
+            }
         ]
-    }}"""
+    }"""
+
+MEAL_ESTIMATE_CACHE_TTL = 7 * 24 * 60 * 60
+# Queued analyses expire if no worker picks them up in time, and are killed if the API call hangs
+MEAL_ANALYSIS_JOB_TTL = 30
+MEAL_ANALYSIS_JOB_TIMEOUT = 60
+
+@lru_cache(maxsize=1)
+def get_anthropic_client():
+    # One client per process so its HTTP connection pool is reused across calls
+    return Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+
+def meal_estimate_cache_key(meal_description):
+    # Identical descriptions get identical estimates, so key on the normalized text
+    return 'meal:' + hashlib.sha1(meal_description.strip().lower().encode()).hexdigest()
+
+def get_cached_nutrition_estimate(meal_description):
+    try:
+        cached = redis_client.get(meal_estimate_cache_key(meal_description))
+        if cached:
+            return orjson.loads(cached)
+    except redis.RedisError as e:
+        logging.warning(f"Meal estimate cache unavailable: {str(e)}")
+    return None
+
+def get_llm_nutrition_estimate(meal_description):
+    """Estimate a meal's nutrition with Claude; also run as a background job by the RQ worker"""
+    cached = get_cached_nutrition_estimate(meal_description)
+    if cached:
+        return cached
+    
+    prompt = NUTRITION_PROMPT_PREFIX + meal_description + NUTRITION_PROMPT_SUFFIX
     
     try:
-        message = anthropic.messages.create(
+        message = get_anthropic_client().messages.create(
             model="claude-3-sonnet-20240229",
             max_tokens=1000,
             temperature=0,
@@ -272,11 +569,54 @@ def get_llm_nutrition_estimate(meal_description):
         )
         
         response_text = message.content[0].text
-        return json.loads(response_text)
+        nutrition_data = orjson.loads(response_text)
         
     except Exception as e:
-        print(f"Error getting nutrition estimate: {e}")
+        logging.error(f"Error getting nutrition estimate: {str(e)}")
         return None
+    
+    try:
+        redis_client.setex(
+            meal_estimate_cache_key(meal_description),
+            MEAL_ESTIMATE_CACHE_TTL,
+            orjson.dumps(nutrition_data)
+        )
+    except redis.RedisError as e:
+        logging.warning(f"Meal estimate cache unavailable: {str(e)}")
+    return nutrition_data
+
+# One row per day of the range with that day's nutrition totals and weight
+CHART_DATA_SQL = text("""
+    WITH RECURSIVE days(day) AS (
+        SELECT :start_date
+        UNION ALL
+        SELECT date(day, '+1 day') FROM days WHERE day < :end_date
+    )
+    SELECT days.day AS day,
+        daily_nutrition_total.protein_total AS protein,
+        daily_nutrition_total.calorie_total AS calories,
+        weight_entry.weight AS weight
+    FROM days
+    LEFT JOIN daily_nutrition_total ON daily_nutrition_total.user_id = :user_id
+        AND daily_nutrition_total.date = days.day
+        AND daily_nutrition_total.entry_count > 0
+    LEFT JOIN weight_entry ON weight_entry.user_id = :user_id AND weight_entry.date = days.day
+    ORDER BY days.day
+""")
+
+# The named exercise from the latest workout of a type
+EXERCISE_HISTORY_SQL = text("""
+    SELECT name, sets, reps, weight
+    FROM workout_exercise
+    WHERE workout_id = (
+        SELECT id FROM workout
+        WHERE user_id = :user_id AND type = :workout_type
+        ORDER BY date DESC, id DESC
+        LIMIT 1
+    ) AND name = :exercise_name
+    ORDER BY position
+    LIMIT 1
+""")
 
 @app.route('/')
 def landing():
@@ -286,17 +626,12 @@ def landing():
 
 @app.route('/nutrition')
 @login_required
+@max_queries(5)
 def nutrition():
-    settings = UserSettings.query.filter_by(user_id=current_user.id).first()
+    settings = current_user.settings
     if not settings:
         return redirect(url_for('register'))
-        
-    print("Debug - Settings object:", settings)  
-    print("Debug - Settings attributes:", {
-        'target_weight': settings.target_weight_kg,
-        'current_weight': settings.current_weight_kg,
-        'starting_weight': settings.starting_weight_kg
-    })
+
 
     # Get latest weight entry for today    
     today = date.today()
@@ -326,7 +661,7 @@ def nutrition():
         direction=weight_direction
     )
     
-    saved_meals = SavedMeal.query.filter_by(user_id=current_user.id).all()
+    saved_meals = SavedMeal.query.filter_by(user_id=current_user.id).order_by(SavedMeal.id).all()
 
     return render_template('nutrition.html',
                          active_tab='nutrition',
@@ -356,7 +691,23 @@ def analyze_meal():
         if not meal_description:
             return jsonify({"error": "No meal description provided"}), 400
         
-        nutrition_data = get_llm_nutrition_estimate(meal_description)
+        nutrition_data = get_cached_nutrition_estimate(meal_description)
+        
+        if not nutrition_data:
+            try:
+                # Enqueued by dotted path: under `python app.py` the function lives in __main__,
+                # which RQ workers can't import
+                job = meal_analysis_queue.enqueue(
+                    'app.get_llm_nutrition_estimate',
+                    meal_description,
+                    meta={'user_id': current_user.id},
+                    ttl=MEAL_ANALYSIS_JOB_TTL,
+                    job_timeout=MEAL_ANALYSIS_JOB_TIMEOUT
+                )
+                return jsonify({"message": "Meal analysis started", "job_id": job.id}), 202
+            except Exception as e:
+                logging.warning(f"Meal analysis could not be queued, analyzing inline: {str(e)}")
+                nutrition_data = get_llm_nutrition_estimate(meal_description)
         
         if nutrition_data:
             return jsonify({
@@ -366,9 +717,36 @@ def analyze_meal():
         else:
             return jsonify({"error": "Could not analyze meal"}), 500
     except Exception as e:
-        print("Error in analyze_meal:", str(e))
+        logging.error(f"Error in analyze_meal: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/analyze_meal/<job_id>')
+@login_required
+def analyze_meal_status(job_id):
+    try:
+        job = Job.fetch(job_id, connection=redis_client)
+    except NoSuchJobError:
+        return jsonify({"error": "Meal analysis not found"}), 404
+    except redis.RedisError as e:
+        logging.error(f"Error fetching meal analysis: {str(e)}")
+        return jsonify({"error": "Could not analyze meal"}), 500
+    
+    if job.meta.get('user_id') != current_user.id:
+        return jsonify({"error": "Meal analysis not found"}), 404
+    
+    if job.is_failed:
+        return jsonify({"error": "Could not analyze meal"}), 500
+    if not job.is_finished:
+        return jsonify({"status": job.get_status().value}), 202
+    
+    nutrition_data = job.return_value()
+    if nutrition_data:
+        return jsonify({
+            "message": "Meal analyzed successfully",
+            "nutrition": nutrition_data
+        }), 200
+    return jsonify({"error": "Could not analyze meal"}), 500
+
 @app.route('/add_nutrition', methods=['POST'])
 @login_required
 def add_nutrition():
@@ -381,28 +759,38 @@ def add_nutrition():
         if data.get('calorie_amount') and int(data['calorie_amount']) < 0:
             return jsonify({"error": "Calorie amount cannot be negative"}), 400
 
+        today = date.today()
         if data.get('saved_meal_id'):
-            meal = SavedMeal.query.filter_by(
-                id=data['saved_meal_id'],
-                user_id=current_user.id
-            ).first_or_404()
-            new_entry = NutritionEntry(
-                user_id=current_user.id,
-                date=date.today(),
-                protein_amount=meal.protein_per_serving,
-                calorie_amount=meal.calories_per_serving,
-                meal_name=meal.name
-            )
+            # Copy the saved meal into a new entry in one INSERT ... SELECT
+            added = db.session.execute(
+                insert(NutritionEntry).from_select(
+                    ['user_id', 'date', 'protein_amount', 'calorie_amount', 'meal_name'],
+                    select(
+                        literal(current_user.id),
+                        literal(today),
+                        SavedMeal.protein_per_serving,
+                        SavedMeal.calories_per_serving,
+                        SavedMeal.name
+                    ).where(
+                        SavedMeal.id == data['saved_meal_id'],
+                        SavedMeal.user_id == current_user.id
+                    )
+                ).returning(NutritionEntry.id)
+            ).first()
+            if added is None:
+                db.session.rollback()
+                return jsonify({"error": "Saved meal not found"}), 404
         else:
             new_entry = NutritionEntry(
                 user_id=current_user.id,
-                date=date.today(),
+                date=today,
                 protein_amount=float(data['protein_amount']),
                 calorie_amount=int(data['calorie_amount']),
                 meal_name=data.get('meal_name', 'Manual entry')
             )
+            db.session.add(new_entry)
 
-        db.session.add(new_entry)
+        refresh_daily_nutrition_total(current_user.id, today)
         db.session.commit()
         logging.info("Successfully added nutrition entry")
         return jsonify({"message": "Nutrition entry added successfully"}), 201
@@ -412,37 +800,72 @@ def add_nutrition():
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
+@app.route('/add_nutrition_bulk', methods=['POST'])
+@login_required
+def add_nutrition_bulk():
+    try:
+        data = request.json
+        if not isinstance(data, list) or not data:
+            return jsonify({"error": "A list of nutrition entries is required"}), 400
+        
+        today = date.today()
+        rows = []
+        for item in data:
+            protein_amount = float(item['protein_amount'])
+            calorie_amount = int(item['calorie_amount'])
+            if protein_amount < 0 or calorie_amount < 0:
+                return jsonify({"error": "Protein and calories cannot be negative"}), 400
+            rows.append({
+                'user_id': current_user.id,
+                'date': today,
+                'protein_amount': protein_amount,
+                'calorie_amount': calorie_amount,
+                'meal_name': item.get('meal_name', 'Manual entry')
+            })
+        
+        # A single executemany INSERT and one commit for the whole batch
+        db.session.execute(insert(NutritionEntry), rows)
+        refresh_daily_nutrition_total(current_user.id, today)
+        db.session.commit()
+        logging.info(f"Successfully added {len(rows)} nutrition entries")
+        return jsonify({"message": f"{len(rows)} nutrition entries added successfully"}), 201
+        
+    except Exception as e:
+        logging.error(f"Error adding nutrition entries: {str(e)}")
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/workouts')
 @login_required
+@max_queries(5)
 def workouts():
     today = date.today()
     
     def workouts_on_date(target_date):
-        return Workout.query.filter(
+        return Workout.query.options(undefer(Workout.exercises)).filter(
             Workout.user_id == current_user.id,
-            Workout.date >= datetime.combine(target_date, datetime.min.time()),
-            Workout.date < datetime.combine(target_date, datetime.max.time())
-        ).order_by(Workout.date.desc()).all()
+            Workout.date == target_date
+        ).order_by(Workout.id.desc()).all()
     
-    todays_workouts = workouts_on_date(today)
-    worked_out_today = len(todays_workouts) > 0 
-        
-    workout_categories = WorkoutCategory.query.filter_by(user_id=current_user.id).all()
+    # Latest workout date per type; the overall latest is the max of these
+    last_completed_by_type = dict(db.session.query(
+        Workout.type,
+        func.max(Workout.date)
+    ).filter(
+        Workout.user_id == current_user.id
+    ).group_by(Workout.type).all())
+    last_workout_date = max(last_completed_by_type.values(), default=None)
     
-    for category in workout_categories:
-        last_workout = Workout.query.filter_by(
-            user_id=current_user.id,
-            type=category.name
-        ).order_by(Workout.date.desc()).first()
+    # The per-type max already answers "worked out today?", so no separate probe query
+    worked_out_today = last_workout_date == today
+    last_day_workouts = workouts_on_date(last_workout_date) if last_workout_date else []
+    last_workout = last_day_workouts[0] if last_day_workouts else None
+    todays_workouts = last_day_workouts if worked_out_today else []
         
-        if last_workout:
-            category.last_completed = last_workout.date
-        else:
-            category.last_completed = None
+    workout_categories = WorkoutCategory.query.filter_by(user_id=current_user.id).order_by(WorkoutCategory.id).all()
     
-    last_workout = Workout.query.filter(
-        Workout.user_id == current_user.id
-    ).order_by(Workout.date.desc()).first()
+    for category in workout_categories:
+        category.last_completed = last_completed_by_type.get(category.name)
 
     return render_template('workouts.html',
                          active_tab='workouts',
@@ -450,10 +873,9 @@ def workouts():
                          worked_out_today=worked_out_today,
                          todays_workouts=todays_workouts,
                          workout_categories=workout_categories,
-                         workouts_on_date=workouts_on_date,
-                         now=datetime.now(),
-                         last_workout=last_workout,  
-                         json=json)
+                         last_day_workouts=last_day_workouts,
+                         today=today,
+                         last_workout=last_workout)
 
 @app.route('/log_workout', methods=['POST'])
 @login_required
@@ -462,9 +884,11 @@ def log_workout():
     new_workout = Workout(
         user_id=current_user.id,
         type=data['type'],
-        exercises=json.dumps(data['exercises'])
+        exercises=data['exercises']
     )
     db.session.add(new_workout)
+    db.session.flush()
+    add_workout_exercise_rows(new_workout)
     db.session.commit()
     return jsonify({"message": "Workout logged successfully"}), 201
 
@@ -479,24 +903,32 @@ def add_weight():
             return jsonify({"error": "Weight is required"}), 400
             
         weight_kg = float(data['weight'])
+        if weight_kg <= 0:
+            return jsonify({"error": "Weight must be positive"}), 400
         
-        existing_entry = WeightEntry.query.filter_by(
-            user_id=current_user.id,
-            date=today
+        # One weight per day is enforced by uq_weight_user_date
+        inserted = db.session.execute(
+            sqlite_insert(WeightEntry).values(
+                user_id=current_user.id,
+                date=today,
+                weight=weight_kg
+            ).on_conflict_do_nothing(
+                index_elements=['user_id', 'date']
+            ).returning(WeightEntry.id)
         ).first()
         
-        if existing_entry:
+        if inserted is None:
+            existing_weight = db.session.execute(
+                select(WeightEntry.weight).where(
+                    WeightEntry.user_id == current_user.id,
+                    WeightEntry.date == today
+                )
+            ).scalar()
             return jsonify({
-                "error": f"Already logged weight of {existing_entry.weight:.1f} kg today"
+                "error": f"Already logged weight of {existing_weight:.1f} kg today"
             }), 400
-            
-        entry = WeightEntry(
-            user_id=current_user.id,
-            date=today,
-            weight=weight_kg
-        )
         
-        settings = UserSettings.query.filter_by(user_id=current_user.id).first()
+        settings = current_user.settings
         settings.current_weight_kg = weight_kg
         
         # Determine new direction based on latest weight
@@ -510,7 +942,6 @@ def add_weight():
         
         settings.max_calories = new_calories
         
-        db.session.add(entry)
         db.session.commit()
         
         return jsonify({
@@ -520,6 +951,7 @@ def add_weight():
         }), 200
         
     except ValueError:
+        db.session.rollback()
         return jsonify({"error": "Please enter a valid weight"}), 400
     except Exception as e:
         db.session.rollback()
@@ -545,27 +977,36 @@ def saved_meals():
             )
             db.session.add(new_meal)
             db.session.commit()
+            invalidate_cached_bodies(user_cache_key(current_user.id, 'meals'))
             return jsonify({"message": "Meal saved successfully", "id": new_meal.id}), 201
         
         except Exception as e:
             db.session.rollback()
             return jsonify({"error": str(e)}), 500
             
-    saved_meals = SavedMeal.query.filter_by(user_id=current_user.id).all()
-    return jsonify([{
-        "id": meal.id,
-        "name": meal.name,
-        "protein_per_serving": meal.protein_per_serving,
-        "calories_per_serving": meal.calories_per_serving
-    } for meal in saved_meals])
+    cache_key = user_cache_key(current_user.id, 'meals')
+    body = get_cached_body(cache_key)
+    if body is None:
+        rows = db.session.execute(
+            select(
+                SavedMeal.id,
+                SavedMeal.name,
+                SavedMeal.protein_per_serving,
+                SavedMeal.calories_per_serving
+            ).where(SavedMeal.user_id == current_user.id).order_by(SavedMeal.id)
+        ).mappings().all()
+        body = orjson.dumps([dict(row) for row in rows])
+        set_cached_body(cache_key, body)
+    return app.response_class(body, mimetype='application/json')
 
 @app.route('/history')
 @login_required
+@max_queries(5)
 def history():
     end_date = date.today()
     start_date = end_date - timedelta(days=29)
     
-    settings = UserSettings.query.filter_by(user_id=current_user.id).first()
+    settings = current_user.settings
     if not settings:
         flash('Please configure your settings first')
         return redirect(url_for('settings'))
@@ -585,50 +1026,41 @@ def history():
         direction=weight_direction
     )
     
-    weight_entries = WeightEntry.query.filter(
-        WeightEntry.user_id == current_user.id,
-        WeightEntry.date >= start_date,
-        WeightEntry.date <= end_date
-    ).all()
-    
-    nutrition_entries = NutritionEntry.query.filter(
-        NutritionEntry.user_id == current_user.id,
-        NutritionEntry.date >= start_date,
-        NutritionEntry.date <= end_date
-    ).all()
-    
-    workouts = Workout.query.filter(
-        Workout.user_id == current_user.id,
-        Workout.date >= datetime.combine(start_date, datetime.min.time()),
-        Workout.date <= datetime.combine(end_date, datetime.max.time())
+    workouts = db.session.execute(
+        select(Workout.date, Workout.type, Workout.exercises).where(
+            Workout.user_id == current_user.id,
+            Workout.date.between(start_date, end_date)
+        ).order_by(Workout.id)
     ).all()
     
-    nutrition_by_date = {}
-    for entry in nutrition_entries:
-        if entry.date not in nutrition_by_date:
-            nutrition_by_date[entry.date] = {'protein': 0, 'calories': 0}
-        nutrition_by_date[entry.date]['protein'] += entry.protein_amount
-        nutrition_by_date[entry.date]['calories'] += entry.calorie_amount
+    rows = db.session.execute(CHART_DATA_SQL, {
+        'user_id': current_user.id,
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat()
+    }).all()
     
-    weight_by_date = {entry.date: entry.weight for entry in weight_entries}
+    chart_data = [
+        dict(zip(('date', 'protein', 'calories', 'weight'), row))
+        for row in rows
+    ]
+    nutrition_by_date = {
+        date.fromisoformat(row.day): {'protein': row.protein, 'calories': row.calories}
+        for row in rows if row.protein is not None
+    }
     
-    chart_data = []
-    current_date = start_date
-    while current_date <= end_date:
-        nutrition = nutrition_by_date.get(current_date, {'protein': None, 'calories': None})
-        chart_data.append({
-            'date': current_date.strftime('%Y-%m-%d'),
-            'protein': nutrition['protein'],
-            'calories': nutrition['calories'],
-            'weight': weight_by_date.get(current_date)
-        })
-        current_date += timedelta(days=1)
+    # First workout of each day, with its exercises parsed once
+    workout_by_date = {}
+    for workout in workouts:
+        if workout.date not in workout_by_date:
+            workout_by_date[workout.date] = {
+                'type': workout.type,
+                'exercises': workout.exercises
+            }
     
     history = []
     current_date = end_date
     while current_date >= start_date:
         nutrition = nutrition_by_date.get(current_date)
-        day_workout = next((w for w in workouts if w.date.date() == current_date), None)
         
         if nutrition:
             calories_status = (
@@ -647,10 +1079,7 @@ def history():
                 'protein_goal': protein_goal,
                 'calories_status': calories_status
             },  
-            'workout': {
-                'type': day_workout.type,
-                'exercises': json.loads(day_workout.exercises)
-            } if day_workout else None
+            'workout': workout_by_date.get(current_date)
         })
         current_date -= timedelta(days=1)
     
@@ -694,7 +1123,7 @@ def login():
     if request.method == 'POST':
         email = request.form.get('email')
         password = request.form.get('password')
-        user = User.query.filter_by(email=email).first()
+        user = User.find_active(email)
         
         if user and user.check_password(password):
             login_user(user)
@@ -718,17 +1147,10 @@ def register():
                     flash(f'{field.replace("_", " ").title()} is required')
                     return redirect(url_for('register'))
 
-            # Create user first
-            user = User(email=request.form.get('email'))
-            user.set_password(request.form.get('password'))
-            
-            if User.query.filter_by(email=user.email).first():
+            if User.find_active(request.form.get('email')):
                 flash('Email already registered')
                 return redirect(url_for('register'))
 
-            db.session.add(user)
-            db.session.commit()
-
             # Get settings data
             starting_weight_kg = float(request.form.get('starting_weight'))
             target_weight_kg = float(request.form.get('target_weight'))
@@ -741,6 +1163,23 @@ def register():
             age = int(request.form.get('age'))
             gender = request.form.get('gender')
             height_cm = float(request.form.get('height'))
+
+            # Same bounds as the user_settings CHECK constraints
+            if not 0 <= age <= 150:
+                flash('Age must be between 0 and 150')
+                return render_template('register.html'), 400
+            if height_cm <= 0:
+                flash('Height must be positive')
+                return render_template('register.html'), 400
+            if activity_level not in ACTIVITY_LEVEL_ENUM.enums:
+                flash('Invalid activity level')
+                return render_template('register.html'), 400
+            if gender not in GENDER_ENUM.enums:
+                flash('Invalid gender')
+                return render_template('register.html'), 400
+
+            user = User(email=request.form.get('email'))
+            user.set_password(request.form.get('password'))
             
             # Get protein ratio based on direction
             protein_goal = request.form.get('protein_goal', 'medium')
@@ -774,22 +1213,29 @@ def register():
                 )
                 settings.max_calories = initial_calories
             except Exception as e:
-                print(f"Calorie calculation error: {str(e)}")
+                logging.error(f"Calorie calculation error: {str(e)}")
                 # Set a reasonable default based on direction
                 settings.max_calories = 2000 if weight_direction == 'loss' else 2800
 
+            # The user, settings and default categories commit together, so a failed
+            # settings insert can't leave behind an account without settings
+            db.session.add(user)
             db.session.add(settings)
-            db.session.commit()
-
+            db.session.flush()
             create_default_workout_categories(user.id)
             db.session.commit()
+            # SQLite can hand a deleted user's id to a new account
+            invalidate_cached_bodies(
+                user_cache_key(user.id, 'meals'),
+                user_cache_key(user.id, 'categories')
+            )
 
             login_user(user)
             return redirect(url_for('nutrition'))
             
         except Exception as e:
             db.session.rollback()
-            print(f"Registration failed with error: {str(e)}")
+            logging.error(f"Registration failed with error: {str(e)}")
             flash('Error during registration. Please try again.')
             return redirect(url_for('register'))
         
@@ -798,7 +1244,7 @@ def register():
 @app.route('/fix_settings', methods=['POST'])
 @login_required
 def fix_settings():
-    settings = UserSettings.query.filter_by(user_id=current_user.id).first()
+    settings = current_user.settings
     if not settings:
         return jsonify({"error": "No settings found"}), 404
         
@@ -817,7 +1263,7 @@ def logout():
 @app.route('/settings')
 @login_required
 def settings():
-    settings = UserSettings.query.filter_by(user_id=current_user.id).first()
+    settings = current_user.settings
     if not settings:
         return redirect(url_for('register'))
     
@@ -847,7 +1293,10 @@ def settings():
 @login_required
 def update_settings():
     data = request.json
-    settings = UserSettings.query.filter_by(user_id=current_user.id).first()
+    settings = current_user.settings
+    
+    if data.get('activity_level') and data['activity_level'] not in ACTIVITY_LEVEL_ENUM.enums:
+        return jsonify({"error": "Invalid activity level"}), 400
     
     try:
         if not settings.start_date:
@@ -899,22 +1348,38 @@ def update_settings():
 @app.route('/delete_nutrition/<int:entry_id>', methods=['POST'])
 @login_required
 def delete_nutrition(entry_id):
-    entry = NutritionEntry.query.filter_by(
-        id=entry_id,
-        user_id=current_user.id
-    ).first_or_404()
-    db.session.delete(entry)
+    deleted = db.session.execute(
+        delete(NutritionEntry).where(
+            NutritionEntry.id == entry_id,
+            NutritionEntry.user_id == current_user.id
+        ).returning(NutritionEntry.date)
+    ).first()
+    if deleted is None:
+        db.session.rollback()
+        abort(404)
+    refresh_daily_nutrition_total(current_user.id, deleted.date)
     db.session.commit()
     return jsonify({"message": "Entry deleted successfully"}), 200
 
 @app.route('/get_workout_categories')
 @login_required 
 def get_workout_categories():
-    categories = WorkoutCategory.query.filter_by(user_id=current_user.id).all()
-    return jsonify([{
-        'name': cat.name,
-        'exercises': cat.get_exercises()  
-    } for cat in categories])
+    cache_key = user_cache_key(current_user.id, 'categories')
+    body = get_cached_body(cache_key)
+    if body is None:
+        rows = db.session.execute(
+            select(WorkoutCategory.name, WorkoutCategory.exercises)
+            .where(WorkoutCategory.user_id == current_user.id).order_by(WorkoutCategory.id)
+        ).all()
+        body = orjson.dumps([{
+            'name': row.name,
+            'exercises': row.exercises
+        } for row in rows])
+        set_cached_body(cache_key, body)
+    return conditional_response(
+        hashlib.md5(body).hexdigest(),
+        lambda: app.response_class(body, mimetype='application/json')
+    )
 
 @app.route('/get_saved_meal/<int:meal_id>', methods=['GET'])
 @login_required
@@ -924,12 +1389,12 @@ def get_saved_meal(meal_id):
         user_id=current_user.id
     ).first_or_404()
     
-    return jsonify({
+    return conditional_response(row_etag(meal), lambda: jsonify({
         'id': meal.id,
         'name': meal.name,
         'protein_per_serving': meal.protein_per_serving,
         'calories_per_serving': meal.calories_per_serving
-    })
+    }))
 
 @app.route('/update_workout_category', methods=['POST'])
 @login_required  
@@ -938,33 +1403,38 @@ def update_workout_category():
     if not data.get('name') or not data.get('exercises'):
         return jsonify({"error": "Name and exercises are required"}), 400
     
-    if data.get('id'):
-        category = WorkoutCategory.query.filter_by(
-            id=data['id'],
-            user_id=current_user.id
-        ).first()
-        if not category:
-            return jsonify({"error": "Category not found"}), 404
-    else:
-        category = WorkoutCategory.query.filter_by(
-            name=data['name'],
-            user_id=current_user.id
-        ).first()
-    
     try:
-        if category:
+        if data.get('id'):
+            category = WorkoutCategory.query.filter_by(
+                id=data['id'],
+                user_id=current_user.id
+            ).first()
+            if not category:
+                return jsonify({"error": "Category not found"}), 404
             category.name = data['name']
-            category.exercises = json.dumps(data['exercises'])
+            category.exercises = data['exercises']
         else:
-            category = WorkoutCategory(
+            # Create the category, or overwrite the user's category of that name
+            stmt = sqlite_insert(WorkoutCategory).values(
                 user_id=current_user.id,
                 name=data['name'],
-                exercises=json.dumps(data['exercises'])
+                exercises=data['exercises'],
+                updated_at=datetime.utcnow()
             )
-            db.session.add(category)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['user_id', 'name'],
+                set_={
+                    'exercises': stmt.excluded.exercises,
+                    'updated_at': stmt.excluded.updated_at
+                }
+            ))
         
         db.session.commit()
+        invalidate_cached_bodies(user_cache_key(current_user.id, 'categories'))
         return jsonify({"success": True})
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": "A category with that name already exists"}), 409
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
@@ -972,49 +1442,53 @@ def update_workout_category():
 @app.route('/delete_saved_meal/<int:meal_id>', methods=['POST'])
 @login_required
 def delete_saved_meal(meal_id):
-    meal = SavedMeal.query.filter_by(
+    deleted = SavedMeal.query.filter_by(
         id=meal_id,
         user_id=current_user.id
-    ).first_or_404()
-    
-    db.session.delete(meal)
+    ).delete(synchronize_session=False)
     db.session.commit()
+    if not deleted:
+        abort(404)
+    invalidate_cached_bodies(user_cache_key(current_user.id, 'meals'))
     return jsonify({"message": "Meal deleted successfully"}), 200
 
 @app.route('/delete_workout_category/<int:category_id>', methods=['POST'])
 @login_required  
 def delete_workout_category(category_id):
-    category = WorkoutCategory.query.filter_by(
-        id=category_id,
-        user_id=current_user.id
-    ).first_or_404()
-    
     try:
-        db.session.delete(category)
+        deleted = WorkoutCategory.query.filter_by(
+            id=category_id,
+            user_id=current_user.id
+        ).delete(synchronize_session=False)
         db.session.commit()
-        return jsonify({"success": True, "message": "Category deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()
         logging.error(f"Error deleting workout category: {str(e)}")
         return jsonify({"success": False, "error": "Error deleting category"}), 500
 
+    if not deleted:
+        abort(404)
+    invalidate_cached_bodies(user_cache_key(current_user.id, 'categories'))
+    return jsonify({"success": True, "message": "Category deleted successfully"}), 200
+
 @app.route('/delete_workout/<int:workout_id>', methods=['POST'])
 @login_required
 def delete_workout(workout_id):
-    workout = Workout.query.filter_by(
-        id=workout_id,
-        user_id=current_user.id
-    ).first_or_404()
-    
     try:
-        db.session.delete(workout)
+        deleted = Workout.query.filter_by(
+            id=workout_id,
+            user_id=current_user.id
+        ).delete(synchronize_session=False)
         db.session.commit()
-        return jsonify({"message": "Workout deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()
         logging.error(f"Error deleting workout: {str(e)}")
         return jsonify({"error": "Error deleting workout"}), 500
 
+    if not deleted:
+        abort(404)
+    return jsonify({"message": "Workout deleted successfully"}), 200
+
 @app.route('/update_nutrition', methods=['POST'])
 @login_required
 def update_nutrition():
@@ -1027,19 +1501,24 @@ def update_nutrition():
             date=date
         ).first()
         
+        protein_amount = float(data['protein'])
+        calorie_amount = int(data['calories'])
+        if protein_amount < 0 or calorie_amount < 0:
+            return jsonify({"error": "Protein and calories cannot be negative"}), 400
         if entry:
-            entry.protein_amount = float(data['protein'])
-            entry.calorie_amount = int(data['calories'])
+            entry.protein_amount = protein_amount
+            entry.calorie_amount = calorie_amount
         else:
             entry = NutritionEntry(
                 user_id=current_user.id,
                 date=date,
-                protein_amount=float(data['protein']),
-                calorie_amount=int(data['calories']),
+                protein_amount=protein_amount,
+                calorie_amount=calorie_amount,
                 meal_name='Manual update'
             )
             db.session.add(entry)
-            
+
+        refresh_daily_nutrition_total(current_user.id, date)
         db.session.commit()
         return jsonify({"message": "Nutrition data updated successfully"}), 200
         
@@ -1056,25 +1535,25 @@ def get_workout_category(category_id):
         user_id=current_user.id
     ).first_or_404()
     
-    return jsonify({
+    return conditional_response(row_etag(category), lambda: jsonify({
         'id': category.id,
         'name': category.name,
-        'exercises': category.get_exercises()
-    })
+        'exercises': category.exercises
+    }))
 
 @app.route('/get_last_workout/<workout_type>')
 @login_required
 def get_last_workout(workout_type):
-    last_workout = Workout.query.filter_by(
+    last_workout = Workout.query.options(undefer(Workout.exercises)).filter_by(
         user_id=current_user.id,
         type=workout_type
-    ).order_by(Workout.date.desc()).first()
+    ).order_by(Workout.date.desc(), Workout.id.desc()).first()
     
     if last_workout:
-        return jsonify({
+        return conditional_response(row_etag(last_workout), lambda: jsonify({
             "type": last_workout.type,
-            "exercises": json.loads(last_workout.exercises)
-        }), 200
+            "exercises": last_workout.exercises
+        }))
     return jsonify({"message": "No previous workout found"}), 404
 
 @app.route('/saved_meals/<int:meal_id>', methods=['PUT'])
@@ -1092,6 +1571,7 @@ def update_saved_meal(meal_id):
         meal.calories_per_serving = int(data['calories_per_serving'])
         
         db.session.commit()
+        invalidate_cached_bodies(user_cache_key(current_user.id, 'meals'))
         return jsonify({"message": "Meal updated successfully", "id": meal.id}), 200
     except Exception as e:
         db.session.rollback()
@@ -1100,16 +1580,14 @@ def update_saved_meal(meal_id):
 @app.route('/get_exercise_history/<workout_type>/<exercise_name>')
 @login_required
 def get_exercise_history(workout_type, exercise_name):
-    last_workout = Workout.query.filter_by(
-        user_id=current_user.id,
-        type=workout_type
-    ).order_by(Workout.date.desc()).first()
+    exercise = db.session.execute(EXERCISE_HISTORY_SQL, {
+        'user_id': current_user.id,
+        'workout_type': workout_type,
+        'exercise_name': exercise_name
+    }).mappings().first()
     
-    if last_workout:
-        exercises = json.loads(last_workout.exercises)
-        for exercise in exercises:
-            if exercise['name'] == exercise_name:
-                return jsonify(exercise), 200
+    if exercise:
+        return jsonify(dict(exercise)), 200
     
     return jsonify({"message": "No history found"}), 404
 
@@ -1124,7 +1602,9 @@ def update_workout(workout_id):
         ).first_or_404()
         
         workout.type = data['type']
-        workout.exercises = json.dumps(data['exercises'])
+        workout.exercises = data['exercises']
+        db.session.execute(delete(WorkoutExercise).where(WorkoutExercise.workout_id == workout.id))
+        add_workout_exercise_rows(workout)
         
         db.session.commit()
         return jsonify({"message": "Workout updated successfully"}), 200
@@ -1133,6 +1613,39 @@ def update_workout(workout_id):
         logging.error(f"Error updating workout: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.cli.command('create-partitions')
+@click.option('--through', type=int, default=lambda: date.today().year + 1, show_default='next year',
+              help='Last year to create a nutrition_entry partition for.')
+def create_partitions(through):
+    """Add yearly nutrition_entry partitions on Postgres, moving their rows out of DEFAULT."""
+    # SQLite never partitions it, and databases upgraded by b41e6f0c2d87 keep the plain table
+    if (db.engine.dialect.name != 'postgresql'
+            or not db.session.execute(text("SELECT to_regclass('nutrition_entry_default')")).scalar()):
+        click.echo('nutrition_entry is not partitioned in this database')
+        return
+
+    for year in range(date.today().year, through + 1):
+        partition = f'nutrition_entry_{year}'
+        if db.session.execute(text('SELECT to_regclass(:name)'), {'name': partition}).scalar():
+            continue
+        start, end = f'{year}-01-01', f'{year + 1}-01-01'
+        # A new partition can't overlap rows already in DEFAULT, so detach it while they move
+        db.session.execute(text('ALTER TABLE nutrition_entry DETACH PARTITION nutrition_entry_default'))
+        db.session.execute(text(
+            f"CREATE TABLE {partition} PARTITION OF nutrition_entry FOR VALUES FROM ('{start}') TO ('{end}')"
+        ))
+        db.session.execute(text(
+            'INSERT INTO nutrition_entry (id, user_id, date, protein_amount, calorie_amount, meal_name) '
+            'SELECT id, user_id, date, protein_amount, calorie_amount, meal_name FROM nutrition_entry_default '
+            'WHERE date >= :start AND date < :end'
+        ), {'start': start, 'end': end})
+        db.session.execute(text(
+            'DELETE FROM nutrition_entry_default WHERE date >= :start AND date < :end'
+        ), {'start': start, 'end': end})
+        db.session.execute(text('ALTER TABLE nutrition_entry ATTACH PARTITION nutrition_entry_default DEFAULT'))
+        db.session.commit()
+        click.echo(f'Created {partition}')
+
 # app runner
 if __name__ == '__main__':
     with app.app_context():
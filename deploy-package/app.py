@@ -1,9 +1,12 @@
 import os
 import logging
+import sqlite3
 from flask import Flask, request, jsonify, render_template, redirect, url_for, flash
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, date, timedelta
 import json
@@ -29,6 +32,14 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        # SQLite ignores ON DELETE CASCADE unless foreign keys are enabled per connection
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -43,10 +54,14 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(128))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    settings = db.relationship('UserSettings', backref='user', uselist=False)
-    saved_meals = db.relationship('SavedMeal', backref='user')
-    nutrition_entries = db.relationship('NutritionEntry', backref='user')
-    workouts = db.relationship('Workout', backref='user')
+    settings = db.relationship('UserSettings', backref='user', uselist=False,
+                               cascade='all, delete-orphan', passive_deletes=True)
+    saved_meals = db.relationship('SavedMeal', backref='user',
+                                  cascade='all, delete-orphan', passive_deletes=True)
+    nutrition_entries = db.relationship('NutritionEntry', backref='user',
+                                        cascade='all, delete-orphan', passive_deletes=True)
+    workouts = db.relationship('Workout', backref='user',
+                               cascade='all, delete-orphan', passive_deletes=True)
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -56,21 +71,21 @@ class User(UserMixin, db.Model):
 
 class UserSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     weight_lbs = db.Column(db.Float, nullable=False)
     protein_ratio = db.Column(db.Float, nullable=False)
     max_calories = db.Column(db.Integer, nullable=False, default=2500)
 
 class SavedMeal(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     name = db.Column(db.String(100), nullable=False)
     protein_per_serving = db.Column(db.Float, nullable=False)
     calories_per_serving = db.Column(db.Integer, nullable=False)
 
 class NutritionEntry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     date = db.Column(db.Date, nullable=False)
     protein_amount = db.Column(db.Float, nullable=False)
     calorie_amount = db.Column(db.Integer, nullable=False)
@@ -78,17 +93,18 @@ class NutritionEntry(db.Model):
 
 class Workout(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     type = db.Column(db.String(50), nullable=False)
     exercises = db.Column(db.Text, nullable=False)
 
 class WorkoutCategory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     name = db.Column(db.String(50), nullable=False) 
     exercises = db.Column(db.Text, nullable=False) 
-    user = db.relationship('User', backref='workout_categories')
+    user = db.relationship('User', backref=db.backref('workout_categories',
+                           cascade='all, delete-orphan', passive_deletes=True))
 
     def get_exercises(self):
         return json.loads(self.exercises)
@@ -323,7 +339,9 @@ def history():
         Workout.date <= datetime.combine(end_date, datetime.max.time())
     ).order_by(Workout.date.desc()).all()
 
-    settings = UserSettings.query.first()
+    settings = UserSettings.query.filter_by(user_id=current_user.id).first()
+    if not settings:
+        return redirect(url_for('home'))
     protein_goal = calculate_protein_goal(settings.weight_lbs, settings.protein_ratio)
     
     chart_data = []
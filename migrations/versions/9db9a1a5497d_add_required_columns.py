@@ -7,6 +7,9 @@ Create Date: 2024-12-12 15:15:25.835730
 """
 from alembic import op
 import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql.named_types import CreateEnumType
+from sqlalchemy.schema import CreateTable
 
 
 # revision identifiers, used by Alembic.
@@ -15,88 +18,247 @@ down_revision = None
 branch_labels = None
 depends_on = None
 
+# Lookup indexes as (name, table, columns), built after all tables exist
+LOOKUP_INDEXES = [
+    ('ix_nutrition_user_date', 'nutrition_entry', ['user_id', 'date']),
+    ('ix_saved_meal_user_id', 'saved_meal', ['user_id']),
+    ('ix_user_settings_user_id', 'user_settings', ['user_id']),
+    ('ix_workout_user_date', 'workout', ['user_id', 'date']),
+    ('ix_workout_user_type_date', 'workout', ['user_id', 'type', 'date']),
+    ('ix_workout_exercise_workout_id', 'workout_exercise', ['workout_id']),
+    ('ix_workout_exercise_user_name', 'workout_exercise', ['user_id', 'name']),
+]
+
+# Postgres-only BRIN indexes on date, for range scans over tables filled roughly in date order
+BRIN_DATE_INDEXES = [
+    ('ix_nutrition_entry_date_brin', 'nutrition_entry'),
+    ('ix_weight_entry_date_brin', 'weight_entry'),
+    ('ix_workout_date_brin', 'workout'),
+]
+
+
+metadata = sa.MetaData()
+
+# Named enum types; Postgres needs these created before the tables that use them
+activity_level_enum = sa.Enum('sedentary', 'light', 'moderate', 'heavy', 'athlete', name='activity_level_enum', create_constraint=True)
+gender_enum = sa.Enum('male', 'female', 'other', name='gender_enum', create_constraint=True)
+ENUMS = [activity_level_enum, gender_enum]
+
+# Table definitions, kept at module level so their DDL is only compiled once per dialect
+TABLES = [
+    sa.Table('user', metadata,
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('email', sa.String(length=254), nullable=False),
+        sa.Column('password_hash', sa.String(length=255), nullable=True),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.func.now(), nullable=False),
+        sa.Column('deleted_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    ),
+    sa.Table('daily_nutrition_total', metadata,
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('protein_total', sa.Float(), nullable=False),
+        sa.Column('calorie_total', sa.Integer(), nullable=False),
+        sa.Column('entry_count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+        sa.PrimaryKeyConstraint('user_id', 'date'),
+        sqlite_with_rowid=False
+    ),
+    sa.Table('nutrition_entry', metadata,
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('protein_amount', sa.Float(), nullable=False),
+        sa.Column('calorie_amount', sa.Integer(), nullable=False),
+        sa.Column('meal_name', sa.String(length=100), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.CheckConstraint('protein_amount >= 0', name='ck_nutrition_protein_nonneg'),
+        sa.CheckConstraint('calorie_amount >= 0', name='ck_nutrition_calorie_nonneg')
+    ),
+    sa.Table('saved_meal', metadata,
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=100), nullable=False),
+        sa.Column('protein_per_serving', sa.Float(), nullable=False),
+        sa.Column('calories_per_serving', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), server_default=sa.func.now(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+        sa.PrimaryKeyConstraint('id')
+    ),
+    sa.Table('user_settings', metadata,
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('current_weight_kg', sa.Float().with_variant(sa.Numeric(precision=5, scale=2), 'postgresql'), nullable=False),
+        sa.Column('target_weight_kg', sa.Float().with_variant(sa.Numeric(precision=5, scale=2), 'postgresql'), nullable=False),
+        sa.Column('starting_weight_kg', sa.Float().with_variant(sa.Numeric(precision=5, scale=2), 'postgresql'), nullable=False),
+        sa.Column('protein_ratio', sa.Float().with_variant(sa.Numeric(precision=5, scale=2), 'postgresql'), nullable=False),
+        sa.Column('max_calories', sa.SmallInteger(), nullable=False),
+        sa.Column('start_date', sa.DateTime(), server_default=sa.func.now(), nullable=False),
+        sa.Column('goal_months', sa.SmallInteger(), nullable=False),
+        sa.Column('activity_level', activity_level_enum, nullable=False),
+        sa.Column('gender', gender_enum, nullable=False),
+        sa.Column('height_inches', sa.Float().with_variant(sa.Numeric(precision=5, scale=2), 'postgresql'), nullable=False),
+        sa.Column('age', sa.SmallInteger(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.CheckConstraint('height_inches > 0', name='ck_settings_height_positive'),
+        sa.CheckConstraint('age BETWEEN 0 AND 150', name='ck_settings_age_range')
+    ),
+    sa.Table('weight_entry', metadata,
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('weight', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'date', name='uq_weight_user_date'),
+        sa.CheckConstraint('weight > 0', name='ck_weight_positive')
+    ),
+    sa.Table('workout', metadata,
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('type', sa.String(length=50), nullable=False),
+        sa.Column('exercises', sa.JSON().with_variant(postgresql.JSONB(), 'postgresql'), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), server_default=sa.func.now(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+        sa.PrimaryKeyConstraint('id')
+    ),
+    sa.Table('workout_exercise', metadata,
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('workout_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('position', sa.SmallInteger(), nullable=False),
+        sa.Column('name', sa.String(length=100), nullable=False),
+        sa.Column('sets', sa.SmallInteger(), nullable=True),
+        sa.Column('reps', sa.SmallInteger(), nullable=True),
+        sa.Column('weight', sa.Float(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+        sa.ForeignKeyConstraint(['workout_id'], ['workout.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+        sa.PrimaryKeyConstraint('id')
+    ),
+    sa.Table('workout_category', metadata,
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('exercises', sa.JSON().with_variant(postgresql.JSONB(), 'postgresql'), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), server_default=sa.func.now(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'name', name='uq_workout_category_user_name')
+    ),
+]
+
+
+# Postgres fillfactor for frequently updated tables, leaving page room for HOT updates.
+# Table has no postgresql_with option, so get_ddl appends the clause itself
+FILLFACTORS = {
+    'user_settings': 90,
+    'weight_entry': 90,
+}
+
+# Postgres tables partitioned BY RANGE on a date column, as table -> partition key.
+# workout stays whole: workout_exercise's FK to workout.id can't target a partitioned table
+PARTITIONS = {
+    'nutrition_entry': 'date',
+}
+# Fixed yearly partitions, so the DDL doesn't depend on when the migration runs. Anything else
+# lands in the DEFAULT partition; `flask create-partitions` adds later years and moves their rows
+FIRST_PARTITION_YEAR = 2024
+LAST_PARTITION_YEAR = 2027
+
+
+def partition_ddl(table, key):
+    """Return the PARTITION OF statements for table's yearly and default partitions."""
+    statements = [
+        f"CREATE TABLE {table}_{year} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+        for year in range(FIRST_PARTITION_YEAR, LAST_PARTITION_YEAR + 1)
+    ]
+    statements.append(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+    return statements
+
+# Compiled CREATE TYPE/TABLE statements, keyed by dialect name
+_DDL_CACHE = {}
+
+
+def get_ddl(dialect):
+    """Return the CREATE TYPE/TABLE statements for dialect, compiling them on first use."""
+    if dialect.name not in _DDL_CACHE:
+        statements = []
+        if dialect.name == 'postgresql':
+            statements += [str(CreateEnumType(enum).compile(dialect=dialect)) for enum in ENUMS]
+        for table in TABLES:
+            statement = str(CreateTable(table).compile(dialect=dialect)).rstrip()
+            if dialect.name == 'postgresql' and table.name in PARTITIONS:
+                key = PARTITIONS[table.name]
+                # A partitioned table's primary key has to include the partition key
+                statement = statement.replace('PRIMARY KEY (id)', f'PRIMARY KEY (id, {key})')
+                statement += f' PARTITION BY RANGE ({key})'
+            if dialect.name == 'postgresql' and table.name in FILLFACTORS:
+                statement += f' WITH (fillfactor = {FILLFACTORS[table.name]})'
+            statements.append(statement)
+            if dialect.name == 'postgresql' and table.name in PARTITIONS:
+                statements += partition_ddl(table.name, PARTITIONS[table.name])
+        _DDL_CACHE[dialect.name] = statements
+    return _DDL_CACHE[dialect.name]
+
 
 def upgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    op.create_table('user',
-    sa.Column('id', sa.Integer(), nullable=False),
-    sa.Column('email', sa.String(length=120), nullable=False),
-    sa.Column('password_hash', sa.String(length=128), nullable=True),
-    sa.Column('created_at', sa.DateTime(), nullable=True),
-    sa.PrimaryKeyConstraint('id'),
-    sa.UniqueConstraint('email')
-    )
-    op.create_table('nutrition_entry',
-    sa.Column('id', sa.Integer(), nullable=False),
-    sa.Column('user_id', sa.Integer(), nullable=False),
-    sa.Column('date', sa.Date(), nullable=False),
-    sa.Column('protein_amount', sa.Float(), nullable=False),
-    sa.Column('calorie_amount', sa.Integer(), nullable=False),
-    sa.Column('meal_name', sa.String(length=100), nullable=True),
-    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
-    sa.PrimaryKeyConstraint('id')
-    )
-    op.create_table('saved_meal',
-    sa.Column('id', sa.Integer(), nullable=False),
-    sa.Column('user_id', sa.Integer(), nullable=False),
-    sa.Column('name', sa.String(length=100), nullable=False),
-    sa.Column('protein_per_serving', sa.Float(), nullable=False),
-    sa.Column('calories_per_serving', sa.Integer(), nullable=False),
-    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
-    sa.PrimaryKeyConstraint('id')
-    )
-    op.create_table('user_settings',
-    sa.Column('id', sa.Integer(), nullable=False),
-    sa.Column('user_id', sa.Integer(), nullable=False),
-    sa.Column('current_weight_kg', sa.Float(), nullable=False),
-    sa.Column('target_weight_kg', sa.Float(), nullable=False),
-    sa.Column('starting_weight_kg', sa.Float(), nullable=False),
-    sa.Column('protein_ratio', sa.Float(), nullable=False),
-    sa.Column('max_calories', sa.Integer(), nullable=False),
-    sa.Column('start_date', sa.DateTime(), nullable=False),
-    sa.Column('goal_months', sa.Integer(), nullable=False),
-    sa.Column('activity_level', sa.String(length=20), nullable=False),
-    sa.Column('gender', sa.String(length=10), nullable=False),
-    sa.Column('height_inches', sa.Float(), nullable=False),
-    sa.Column('age', sa.Integer(), nullable=False),
-    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
-    sa.PrimaryKeyConstraint('id')
-    )
-    op.create_table('weight_entry',
-    sa.Column('id', sa.Integer(), nullable=False),
-    sa.Column('user_id', sa.Integer(), nullable=False),
-    sa.Column('date', sa.Date(), nullable=False),
-    sa.Column('weight', sa.Float(), nullable=False),
-    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
-    sa.PrimaryKeyConstraint('id')
-    )
-    op.create_table('workout',
-    sa.Column('id', sa.Integer(), nullable=False),
-    sa.Column('user_id', sa.Integer(), nullable=False),
-    sa.Column('date', sa.DateTime(), nullable=False),
-    sa.Column('type', sa.String(length=50), nullable=False),
-    sa.Column('exercises', sa.Text(), nullable=False),
-    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
-    sa.PrimaryKeyConstraint('id')
-    )
-    op.create_table('workout_category',
-    sa.Column('id', sa.Integer(), nullable=False),
-    sa.Column('user_id', sa.Integer(), nullable=False),
-    sa.Column('name', sa.String(length=50), nullable=False),
-    sa.Column('exercises', sa.Text(), nullable=False),
-    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
-    sa.PrimaryKeyConstraint('id')
-    )
-    # ### end Alembic commands ###
+    # SQLite pragmas (WAL, synchronous=NORMAL, mmap, foreign_keys) are already set on every
+    # connection by app.set_sqlite_pragma, which env.py's engine goes through as well
+    dialect = op.get_context().dialect
+    if dialect.name == 'postgresql':
+        # Send every CREATE TABLE in one multi-statement round trip
+        op.execute(';\n'.join(get_ddl(dialect)))
+    else:
+        for statement in get_ddl(dialect):
+            op.execute(statement)
+
+    # Case-insensitive email uniqueness, ignoring soft-deleted accounts
+    op.create_index('uq_user_email_active', 'user', [sa.text('lower(email)')], unique=True,
+                    sqlite_where=sa.text('deleted_at IS NULL'), postgresql_where=sa.text('deleted_at IS NULL'))
+
+    if dialect.name == 'postgresql':
+        # CONCURRENTLY can't run inside the migration transaction, and avoids
+        # write-locking the table if these are ever rebuilt on live data
+        with op.get_context().autocommit_block():
+            # Partitioned tables can't be indexed CONCURRENTLY; they're empty here anyway
+            for name, table, columns in LOOKUP_INDEXES:
+                op.create_index(name, table, columns, unique=False,
+                                postgresql_concurrently=table not in PARTITIONS, if_not_exists=True)
+            # Postgres-only, so it lives here rather than on the model
+            op.create_index('ix_workout_exercises_gin', 'workout', ['exercises'], unique=False,
+                            postgresql_using='gin', postgresql_concurrently=True, if_not_exists=True)
+            for name, table in BRIN_DATE_INDEXES:
+                op.create_index(name, table, ['date'], unique=False,
+                                postgresql_using='brin', postgresql_with={'pages_per_range': 32},
+                                postgresql_concurrently=table not in PARTITIONS, if_not_exists=True)
+    else:
+        for name, table, columns in LOOKUP_INDEXES:
+            op.create_index(name, table, columns, unique=False)
 
 
 def downgrade():
+    if op.get_context().dialect.name == 'postgresql':
+        # One CASCADE drop lets Postgres work out the FK order and takes the indexes with it
+        op.execute('DROP TABLE IF EXISTS ' + ', '.join(f'"{table.name}"' for table in reversed(TABLES)) + ' CASCADE')
+        op.execute('DROP TYPE IF EXISTS ' + ', '.join(enum.name for enum in ENUMS))
+        return
+
+    for name, table, columns in reversed(LOOKUP_INDEXES):
+        op.drop_index(name, table_name=table)
+    op.drop_index('uq_user_email_active', table_name='user')
+
     # ### commands auto generated by Alembic - please adjust! ###
     op.drop_table('workout_category')
+    op.drop_table('workout_exercise')
     op.drop_table('workout')
     op.drop_table('weight_entry')
     op.drop_table('user_settings')
     op.drop_table('saved_meal')
     op.drop_table('nutrition_entry')
+    op.drop_table('daily_nutrition_total')
     op.drop_table('user')
     # ### end Alembic commands ###
@@ -0,0 +1,352 @@
+"""upgrade databases created by the original 9db9a1a5497d
+
+Revision ID: b41e6f0c2d87
+Revises: 9db9a1a5497d
+Create Date: 2026-10-15 09:12:41.508213
+
+"""
+from alembic import context, op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql.named_types import CreateEnumType
+
+
+# revision identifiers, used by Alembic.
+revision = 'b41e6f0c2d87'
+down_revision = '9db9a1a5497d'
+branch_labels = None
+depends_on = None
+
+# 9db9a1a5497d was extended in place after it had already been applied, so databases created
+# by its first version are still on that schema. This brings them up to what 9db9a1a5497d
+# creates today; databases created by the current 9db9a1a5497d already match and skip it.
+# Every step checks what is already there, so a run that stopped part way finishes when retried.
+# nutrition_entry is left unpartitioned on Postgres, since that would mean rebuilding the table.
+
+# Names the batch reflection gives SQLite's unnamed constraints, so they can be dropped
+NAMING_CONVENTION = {
+    'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s',
+    'uq': 'uq_%(table_name)s_%(column_0_name)s',
+}
+
+# Tables whose user_id foreign key gains ON DELETE CASCADE
+USER_CHILD_TABLES = ['nutrition_entry', 'saved_meal', 'user_settings', 'weight_entry', 'workout', 'workout_category']
+
+# New unique constraints as {table: (name, columns)}. Rows that break them are deleted first;
+# the newest one wins, as with the app's upserts
+UNIQUE_CONSTRAINTS = {
+    'weight_entry': ('uq_weight_user_date', ['user_id', 'date']),
+    'workout_category': ('uq_workout_category_user_name', ['user_id', 'name']),
+}
+
+# New CHECK constraints as {table: [(name, condition)]}
+CHECK_CONSTRAINTS = {
+    'nutrition_entry': [
+        ('ck_nutrition_protein_nonneg', 'protein_amount >= 0'),
+        ('ck_nutrition_calorie_nonneg', 'calorie_amount >= 0'),
+    ],
+    'user_settings': [
+        ('ck_settings_height_positive', 'height_inches > 0'),
+        ('ck_settings_age_range', 'age BETWEEN 0 AND 150'),
+    ],
+    'weight_entry': [
+        ('ck_weight_positive', 'weight > 0'),
+    ],
+}
+
+# Tables that gain an updated_at column
+UPDATED_AT_TABLES = ['saved_meal', 'workout', 'workout_category']
+
+# Lookup indexes as (name, table, columns), matching 9db9a1a5497d's
+LOOKUP_INDEXES = [
+    ('ix_nutrition_user_date', 'nutrition_entry', ['user_id', 'date']),
+    ('ix_saved_meal_user_id', 'saved_meal', ['user_id']),
+    ('ix_user_settings_user_id', 'user_settings', ['user_id']),
+    ('ix_workout_user_date', 'workout', ['user_id', 'date']),
+    ('ix_workout_user_type_date', 'workout', ['user_id', 'type', 'date']),
+]
+
+activity_level_enum = sa.Enum('sedentary', 'light', 'moderate', 'heavy', 'athlete', name='activity_level_enum', create_constraint=True)
+gender_enum = sa.Enum('male', 'female', 'other', name='gender_enum', create_constraint=True)
+settings_decimal = sa.Float().with_variant(sa.Numeric(precision=5, scale=2), 'postgresql')
+exercises_json = sa.JSON().with_variant(postgresql.JSONB(), 'postgresql')
+
+
+def column_changes():
+    """Return {table: [(new column, postgresql USING expression)]} for columns whose definition changed."""
+    return {
+        'user': [
+            (sa.Column('email', sa.String(length=254), nullable=False), None),
+            (sa.Column('password_hash', sa.String(length=255), nullable=True), None),
+            (sa.Column('created_at', sa.DateTime(), server_default=sa.func.now(), nullable=False), None),
+        ],
+        'user_settings': [
+            (sa.Column('current_weight_kg', settings_decimal, nullable=False), None),
+            (sa.Column('target_weight_kg', settings_decimal, nullable=False), None),
+            (sa.Column('starting_weight_kg', settings_decimal, nullable=False), None),
+            (sa.Column('protein_ratio', settings_decimal, nullable=False), None),
+            (sa.Column('max_calories', sa.SmallInteger(), nullable=False), None),
+            (sa.Column('start_date', sa.DateTime(), server_default=sa.func.now(), nullable=False), None),
+            (sa.Column('goal_months', sa.SmallInteger(), nullable=False), None),
+            (sa.Column('activity_level', activity_level_enum, nullable=False), 'activity_level::activity_level_enum'),
+            (sa.Column('gender', gender_enum, nullable=False), 'gender::gender_enum'),
+            (sa.Column('height_inches', settings_decimal, nullable=False), None),
+            (sa.Column('age', sa.SmallInteger(), nullable=False), None),
+        ],
+        'workout': [
+            (sa.Column('date', sa.Date(), nullable=False), 'date::date'),
+            (sa.Column('exercises', exercises_json, nullable=False), 'exercises::jsonb'),
+        ],
+        'workout_category': [
+            (sa.Column('exercises', exercises_json, nullable=False), 'exercises::jsonb'),
+        ],
+    }
+
+
+def user_fk_name(table, dialect):
+    """Name of table's user_id foreign key: Postgres' default, or NAMING_CONVENTION's on SQLite."""
+    if dialect.name == 'postgresql':
+        return f'{table}_user_id_fkey'
+    return f'fk_{table}_user_id_user'
+
+
+def reflect(method, table):
+    """Inspector.<method>(table) on a fresh inspector; [] offline, where every step is rendered."""
+    if context.is_offline_mode():
+        return []
+    return getattr(sa.inspect(op.get_bind()), method)(table)
+
+
+def has_table(name):
+    """Whether name exists; `python app.py` runs db.create_all(), which may have added the new tables."""
+    return not context.is_offline_mode() and sa.inspect(op.get_bind()).has_table(name)
+
+
+def index_state(name):
+    """None if index name is missing, else whether it is valid; failed CONCURRENTLY builds leave it invalid."""
+    if op.get_context().dialect.name == 'postgresql':
+        return op.get_bind().execute(
+            sa.text('SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'), {'name': name}
+        ).scalar()
+    # SQLAlchemy doesn't reflect SQLite expression indexes, so look in the catalog
+    found = op.get_bind().execute(
+        sa.text("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"), {'name': name}
+    ).scalar()
+    return True if found else None
+
+
+def upgrade_pending():
+    """Whether the database is still on (or part way from) the schema the first 9db9a1a5497d created."""
+    if context.is_offline_mode():
+        # Nothing to inspect. A script starting at 9db9a1a5497d gets the full upgrade; one starting
+        # from base already renders what 9db9a1a5497d creates today, so this adds nothing to it
+        return context.get_starting_revision_argument() == down_revision
+    # uq_user_email_active is built last, so it only exists once a run has finished
+    return index_state('uq_user_email_active') is not True
+
+
+def create_index_concurrently(name, table, columns, unique=False, **kw):
+    """Build an index on Postgres without blocking writes, replacing one a failed build left invalid."""
+    if not context.is_offline_mode() and index_state(name) is False:
+        op.drop_index(name, table_name=table, postgresql_concurrently=True)
+    op.create_index(name, table, columns, unique=unique, postgresql_concurrently=True, if_not_exists=True, **kw)
+
+
+def upgrade():
+    if not upgrade_pending():
+        return
+
+    dialect = op.get_context().dialect
+    sqlite = dialect.name == 'sqlite'
+    offline = context.is_offline_mode()
+    if sqlite:
+        # Rebuilding "user" would otherwise cascade its implicit DELETE into every child table.
+        # The pragma is ignored inside a transaction, hence the autocommit blocks
+        with op.get_context().autocommit_block():
+            op.execute('PRAGMA foreign_keys=OFF')
+    elif offline:
+        op.execute(CreateEnumType(activity_level_enum))
+        op.execute(CreateEnumType(gender_enum))
+    else:
+        activity_level_enum.create(op.get_bind(), checkfirst=True)
+        gender_enum.create(op.get_bind(), checkfirst=True)
+
+    op.execute('UPDATE "user" SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL')
+    for table, (_, columns) in UNIQUE_CONSTRAINTS.items():
+        group_by = ', '.join(columns)
+        op.execute(f'DELETE FROM {table} WHERE id NOT IN (SELECT MAX(id) FROM {table} GROUP BY {group_by})')
+
+    # The old columns took any string. Unknown values become 'moderate' (fix_settings' default)
+    # and 'other', so the enum types (CHECKs on SQLite) accept every row and the ORM can load it
+    settings_types = {column['name']: column['type'] for column in reflect('get_columns', 'user_settings')}
+    for column, enum, fallback in (('activity_level', activity_level_enum, 'moderate'), ('gender', gender_enum, 'other')):
+        if isinstance(settings_types.get(column), sa.Enum):
+            # Postgres converted it on an earlier run, so every value is already valid
+            continue
+        allowed = ', '.join(f"'{value}'" for value in enum.enums)
+        op.execute(f'UPDATE user_settings SET {column} = lower(trim({column}))')
+        op.execute(f"UPDATE user_settings SET {column} = '{fallback}' "
+                   f'WHERE {column} IS NULL OR {column} NOT IN ({allowed})')
+
+    if sqlite:
+        # workout.date held full datetimes, which never equal the bare dates the app now
+        # queries with; Postgres converts them with date::date when the column type changes
+        op.execute('UPDATE workout SET date = date(date)')
+
+    changes = column_changes()
+    for table in ['user'] + USER_CHILD_TABLES:
+        columns = {column['name'] for column in reflect('get_columns', table)}
+        uniques = reflect('get_unique_constraints', table)
+        check_names = {check['name'] for check in reflect('get_check_constraints', table)}
+        if table == 'user':
+            add_deleted_at = 'deleted_at' not in columns
+            drop_email_unique = offline or any(unique['column_names'] == ['email'] for unique in uniques)
+            pending = add_deleted_at or drop_email_unique
+        else:
+            replace_fk = not any(
+                fk['constrained_columns'] == ['user_id'] and fk['options'].get('ondelete', '').upper() == 'CASCADE'
+                for fk in reflect('get_foreign_keys', table)
+            )
+            add_updated_at = table in UPDATED_AT_TABLES and 'updated_at' not in columns
+            add_checks = [(name, condition) for name, condition in CHECK_CONSTRAINTS.get(table, [])
+                          if name not in check_names]
+            add_unique = (table in UNIQUE_CONSTRAINTS
+                          and UNIQUE_CONSTRAINTS[table][0] not in {unique['name'] for unique in uniques})
+            pending = replace_fk or add_updated_at or add_checks or add_unique
+        if not pending:
+            # Done on an earlier run; each table's changes land together. Rebuilding it again
+            # would also repeat the enum CHECKs SQLite already has
+            continue
+
+        changed = changes.get(table, [])
+        if sqlite:
+            # Left behind if an earlier rebuild of this table stopped part way
+            op.execute(f'DROP TABLE IF EXISTS _alembic_tmp_{table}')
+        # SQLite rebuilds each table; declaring the new types up front copies the rows without
+        # CASTs, which would mangle TEXT dates and JSON. Postgres alters the columns in place
+        with op.batch_alter_table(table, naming_convention=NAMING_CONVENTION,
+                                  reflect_args=[column for column, using in changed] if sqlite else (),
+                                  recreate='always' if sqlite else 'auto') as batch_op:
+            if not sqlite:
+                for column, using in changed:
+                    batch_op.alter_column(column.name, type_=column.type, existing_nullable=column.nullable,
+                                          server_default=column.server_default.arg if column.server_default else False,
+                                          postgresql_using=using)
+            if table == 'user':
+                if not sqlite:
+                    batch_op.alter_column('created_at', existing_type=sa.DateTime(), nullable=False)
+                if add_deleted_at:
+                    batch_op.add_column(sa.Column('deleted_at', sa.DateTime(), nullable=True))
+                if drop_email_unique:
+                    batch_op.drop_constraint('user_email_key' if not sqlite else 'uq_user_email', type_='unique')
+                continue
+
+            if replace_fk:
+                batch_op.drop_constraint(user_fk_name(table, dialect), type_='foreignkey')
+                batch_op.create_foreign_key(user_fk_name(table, dialect), 'user', ['user_id'], ['id'],
+                                            ondelete='CASCADE', deferrable=True, initially='DEFERRED')
+            if add_updated_at:
+                batch_op.add_column(sa.Column('updated_at', sa.DateTime(), server_default=sa.func.now(), nullable=True))
+            for name, condition in add_checks:
+                batch_op.create_check_constraint(name, condition)
+            if add_unique:
+                name, unique_columns = UNIQUE_CONSTRAINTS[table]
+                batch_op.create_unique_constraint(name, unique_columns)
+
+    # The old UNIQUE(email) was case-sensitive, so a@x.com and A@X.com could both register. The
+    # newest account for each address stays active and the older ones are soft-deleted, with
+    # their rows kept, so uq_user_email_active can be built
+    op.execute(
+        'UPDATE "user" SET deleted_at = CURRENT_TIMESTAMP WHERE deleted_at IS NULL AND id NOT IN '
+        '(SELECT MAX(id) FROM "user" WHERE deleted_at IS NULL GROUP BY lower(email))'
+    )
+
+    if not has_table('daily_nutrition_total'):
+        op.create_table('daily_nutrition_total',
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('date', sa.Date(), nullable=False),
+            sa.Column('protein_total', sa.Float(), nullable=False),
+            sa.Column('calorie_total', sa.Integer(), nullable=False),
+            sa.Column('entry_count', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+            sa.PrimaryKeyConstraint('user_id', 'date'),
+            sqlite_with_rowid=False
+        )
+    # Rebuilt from the entries in full, since db.create_all() may have left a partial table
+    op.execute('DELETE FROM daily_nutrition_total')
+    op.execute(
+        'INSERT INTO daily_nutrition_total (user_id, date, protein_total, calorie_total, entry_count) '
+        'SELECT user_id, date, SUM(protein_amount), SUM(calorie_amount), COUNT(*) '
+        'FROM nutrition_entry GROUP BY user_id, date'
+    )
+    if not has_table('workout_exercise'):
+        op.create_table('workout_exercise',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('workout_id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('position', sa.SmallInteger(), nullable=False),
+            sa.Column('name', sa.String(length=100), nullable=False),
+            sa.Column('sets', sa.SmallInteger(), nullable=True),
+            sa.Column('reps', sa.SmallInteger(), nullable=True),
+            sa.Column('weight', sa.Float(), nullable=True),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+            sa.ForeignKeyConstraint(['workout_id'], ['workout.id'], ondelete='CASCADE', deferrable=True, initially='DEFERRED'),
+            sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_workout_exercise_workout_id', 'workout_exercise', ['workout_id'], unique=False)
+        op.create_index('ix_workout_exercise_user_name', 'workout_exercise', ['user_id', 'name'], unique=False)
+
+    # One row per named exercise object in each workout's JSON, at its position in the list,
+    # as add_workout_exercise_rows writes them; rebuilt in full for the same reason as above
+    op.execute('DELETE FROM workout_exercise')
+    if sqlite:
+        op.execute(
+            'INSERT INTO workout_exercise (workout_id, user_id, position, name, sets, reps, weight) '
+            "SELECT workout.id, workout.user_id, exercise.key, json_extract(exercise.value, '$.name'), "
+            "json_extract(exercise.value, '$.sets'), json_extract(exercise.value, '$.reps'), "
+            "json_extract(exercise.value, '$.weight') "
+            'FROM workout, json_each(workout.exercises) AS exercise '
+            "WHERE json_type(workout.exercises) = 'array' AND exercise.type = 'object' "
+            "AND json_extract(exercise.value, '$.name') IS NOT NULL"
+        )
+    else:
+        op.execute(
+            'INSERT INTO workout_exercise (workout_id, user_id, position, name, sets, reps, weight) '
+            "SELECT workout.id, workout.user_id, exercise.position - 1, exercise.value ->> 'name', "
+            "(exercise.value ->> 'sets')::smallint, (exercise.value ->> 'reps')::smallint, "
+            "(exercise.value ->> 'weight')::float "
+            'FROM workout CROSS JOIN LATERAL jsonb_array_elements('
+            "CASE WHEN jsonb_typeof(workout.exercises) = 'array' THEN workout.exercises ELSE '[]'::jsonb END"
+            ') WITH ORDINALITY AS exercise(value, position) '
+            "WHERE jsonb_typeof(exercise.value) = 'object' AND exercise.value ->> 'name' IS NOT NULL"
+        )
+
+    if sqlite:
+        with op.get_context().autocommit_block():
+            op.execute('PRAGMA foreign_keys=ON')
+        for name, table, columns in LOOKUP_INDEXES:
+            op.create_index(name, table, columns, unique=False, if_not_exists=True)
+        # Built last, since upgrade_pending() takes it to mean the upgrade finished
+        op.create_index('uq_user_email_active', 'user', [sa.text('lower(email)')], unique=True,
+                        sqlite_where=sa.text('deleted_at IS NULL'))
+        return
+
+    op.execute('ALTER TABLE user_settings SET (fillfactor = 90)')
+    op.execute('ALTER TABLE weight_entry SET (fillfactor = 90)')
+    # These tables hold live data, so build the indexes without blocking writes
+    with op.get_context().autocommit_block():
+        for name, table, columns in LOOKUP_INDEXES:
+            create_index_concurrently(name, table, columns)
+        create_index_concurrently('ix_workout_exercises_gin', 'workout', ['exercises'], postgresql_using='gin')
+        for table in ('nutrition_entry', 'weight_entry', 'workout'):
+            create_index_concurrently(f'ix_{table}_date_brin', table, ['date'],
+                                      postgresql_using='brin', postgresql_with={'pages_per_range': 32})
+        # Built last, since upgrade_pending() takes a valid one to mean the upgrade finished
+        create_index_concurrently('uq_user_email_active', 'user', [sa.text('lower(email)')], unique=True,
+                                  postgresql_where=sa.text('deleted_at IS NULL'))
+
+
+def downgrade():
+    # Everything upgrade() adds is part of what 9db9a1a5497d creates today, so there is
+    # nothing to take away when stepping back to it
+    pass